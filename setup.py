@@ -29,5 +29,6 @@ setuptools.setup(
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8"
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
+    extras_require={"numpy": ["numpy"]},
 )
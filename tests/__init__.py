@@ -1,8 +1,220 @@
+import copy
 import os
+import shutil
+import subprocess
+import sys
 import unittest
 
 import vmf_tool
 
+try:
+    import numpy  # noqa: F401
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+
+@unittest.skipUnless(has_numpy, "numpy is not installed")
+class TestDisplacement(unittest.TestCase):
+
+    def setUp(self):
+        self.vmf = vmf_tool.Vmf("tests/mapsrc/test2.vmf")
+
+    def test_change_power(self):
+        lods = self.vmf.displacement_lods(4)
+        self.assertEqual(len(lods), 3)
+        for lod in lods.values():
+            self.assertEqual(lod.power, 4)
+            self.assertEqual(len(lod.normals), 17)
+            self.assertTrue(all(len(row) == 17 for row in lod.distances))
+        self.assertIs(lods[(714, 564)], self.vmf.displacement_lods(4)[(714, 564)])
+        # subdividing then simplifying returns to the original grid
+        displacement = lods[(714, 564)].resampled(3)
+        original = [f for f in self.vmf.brushes[714].faces if f.id == 564][0].displacement
+        self.assertEqual(original.alphas, displacement.alphas)
+        for normal_row, row, original_row in zip(original.normals, displacement.distances, original.distances):
+            for normal, distance, original_distance in zip(normal_row, row, original_row):
+                if normal.magnitude() != 0:
+                    self.assertAlmostEqual(distance, original_distance)
+        original.change_power(2)
+        self.assertEqual(original.power, 2)
+        self.assertEqual(len(original.alphas), 5)
+
+    def test_lod_cache(self):
+        lod = self.vmf.displacement_lods(4)[(714, 564)]
+        original = [f for f in self.vmf.brushes[714].faces if f.id == 564][0].displacement
+        original.alphas[0] = (255.0,) * len(original.alphas[0])  # editing the grids in place invalidates the cache
+        new_lod = self.vmf.displacement_lods(4)[(714, 564)]
+        self.assertIsNot(new_lod, lod)
+        self.assertEqual(new_lod.alphas[0][0], 255.0)
+        same_power = original.resampled(original.power)  # doesn't share the original's grids
+        same_power.normals[0][0].x += 1
+        same_power.distances[0] = (0.0,) * len(same_power.distances[0])
+        self.assertNotEqual(original.normals[0][0], same_power.normals[0][0])
+        self.assertNotEqual(original.distances[0], same_power.distances[0])
+
+    def tearDown(self):
+        del self.vmf
+
+
+@unittest.skipUnless(has_numpy, "numpy is not installed")
+class TestBrushQueries(unittest.TestCase):
+
+    def test_brushes_containing(self):
+        vmf = vmf_tool.Vmf("tests/mapsrc/test.vmf")
+        points = [(0, 0, 0), (64, 0, 0), (65, 0, 0), (10, -20, 30)]
+        self.assertEqual(vmf.brushes_containing(points), {0: [1], 1: [1], 3: [1]})
+        batch_size = vmf_tool.brushes.POINT_BATCH_SIZE
+        vmf_tool.brushes.POINT_BATCH_SIZE = 3  # results mustn't depend on how points are batched
+        try:
+            self.assertEqual(vmf.brushes_containing(points), {0: [1], 1: [1], 3: [1]})
+        finally:
+            vmf_tool.brushes.POINT_BATCH_SIZE = batch_size
+
+    def test_overlapping_brushes(self):
+        vmf = vmf_tool.Vmf("tests/mapsrc/test2.vmf")
+        overlaps = vmf.overlapping_brushes()
+        # the sweep & prune broad-phase mustn't miss any pair
+        axes = {i: vmf_tool.brushes.separating_axes_of(b) for i, b in vmf.brushes.items()}
+        brush_ids = list(vmf.brushes)
+        all_overlaps = [(a, b) for i, a in enumerate(brush_ids) for b in brush_ids[i + 1:]
+                        if vmf_tool.brushes.solids_overlap(axes[a], axes[b])]
+        self.assertEqual(sorted(overlaps), sorted(all_overlaps))
+        self.assertIn((40, 62), overlaps)
+
+    def test_redundant_plane(self):
+        with open("tests/mapsrc/test.vmf", "r") as vmf_file:
+            text = vmf_file.read()
+        # a second +X side, outside the brush; it's polygon is clipped away entirely
+        side = text.index("\t\tside\n")
+        redundant_side = text[side:text.index("\t\tside\n", side + 1)]
+        redundant_side = redundant_side.replace('"id" "1"', '"id" "7"').replace("(64 ", "(128 ")
+        text = text[:side] + redundant_side + text[side:]
+        namespace = vmf_tool.parser.parse(text)
+        solid = vmf_tool.brushes.Solid(namespace.world.solid)
+        self.assertEqual(solid.faces[0].polygon, [])
+        axes = vmf_tool.brushes.separating_axes_of(solid)
+        self.assertTrue(vmf_tool.brushes.solids_overlap(axes, axes))
+        mins, maxs = vmf_tool.brushes.bounds_of(solid)
+        self.assertEqual((list(mins), list(maxs)), ([-64] * 3, [64] * 3))
+
+
+@unittest.skipUnless(has_numpy, "numpy is not installed")
+class TestFaceData(unittest.TestCase):
+
+    def test_derived_data(self):
+        vmf = vmf_tool.Vmf("tests/mapsrc/test.vmf")
+        solid = vmf.brushes[1]
+        face = solid.faces[0]
+        self.assertEqual(face.area, 128 * 128)
+        self.assertEqual(face.centroid, vmf_tool.vector.vec3(64, 0, 0))
+        self.assertEqual(solid.area, 6 * 128 * 128)
+        uvs = [face.uv_at(vertex) for vertex in face.polygon]
+        self.assertEqual(face.uv_bounds, (tuple(map(min, zip(*uvs))), tuple(map(max, zip(*uvs)))))
+        derived = face.derived
+        self.assertIs(vmf_tool.brushes.derive_faces([face])[0], derived)
+        face.vaxis.scale /= 2  # changing the texture axes invalidates the cache
+        uvs = [face.uv_at(vertex) for vertex in face.polygon]
+        self.assertEqual(face.uv_bounds, (tuple(map(min, zip(*uvs))), tuple(map(max, zip(*uvs)))))
+        self.assertIsNot(face.derived, derived)
+        face.polygon = [tuple(axis / 2 for axis in vertex) for vertex in face.polygon]  # so does editing the polygon
+        self.assertEqual(face.area, 64 * 64)
+        self.assertEqual(face.centroid, vmf_tool.vector.vec3(32, 0, 0))
+
+    def test_lightmap_report(self):
+        vmf = vmf_tool.Vmf("tests/mapsrc/test2.vmf")
+        report = vmf.lightmap_report()
+        faces = [f for b in vmf.brushes.values() for f in b.faces if not f.material.upper().startswith("TOOLS/")]
+        self.assertEqual(report["faces"], len(faces))
+        self.assertEqual(report["luxels"], sum(f.luxel_count for f in faces))
+        self.assertEqual(report["luxels"], sum(report["by_material"].values()))
+        self.assertEqual(report["luxels"], sum(report["by_lightmap_scale"].values()))
+
+
+class TestImport(unittest.TestCase):
+
+    def test_lazy_submodules(self):
+        code = "import sys, vmf_tool; print(' '.join(sorted(m for m in sys.modules if m.startswith('vmf_tool'))))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.split(), ["vmf_tool"])
+        self.assertIs(vmf_tool.Vmf, vmf_tool.vmf.Vmf)
+
+
+class TestParser(unittest.TestCase):
+
+    def test_parse_parallel(self):
+        def tree(value):  # comparable form of a Namespace, including _line
+            if isinstance(value, list):
+                return [tree(v) for v in value]
+            elif isinstance(value, vmf_tool.parser.Namespace):
+                return [(k, tree(v)) for k, v in value.items()]
+            return value
+
+        filename = "tests/mapsrc/test2.vmf"
+        with open(filename, "r") as vmf_file:
+            namespace = vmf_tool.parser.parse(vmf_file)
+        # a small chunk_size also cuts up world
+        parallel_namespace = vmf_tool.parser.parse_parallel(filename, processes=2, chunk_size=2 ** 12)
+        self.assertEqual(tree(namespace), tree(parallel_namespace))
+        self.assertIs(parallel_namespace.world.solids[0]._parent, parallel_namespace.world)
+
+    def test_recovery(self):
+        text = "\n".join(["versioninfo", "{", '"editorversion" "400"', '"a" "b" "c"', "}", "}",
+                          "world", "{", '"id" "1"', '"classname" "worldspawn"', "{", '"lost" "block"', "}",
+                          '"skyname" "sky_day01_01"', "cameras", "{"])
+        with self.assertRaises(ValueError):
+            vmf_tool.parser.parse(text)
+        diagnostics = list()
+        namespace = vmf_tool.parser.parse(text, diagnostics=diagnostics)
+        self.assertEqual([(d.line, d.scope, d.kind) for d in diagnostics],
+                         [(3, ".versioninfo", "malformed keyvalue"),
+                          (5, "", "unexpected closing brace"),
+                          (10, ".world", "invalid block"),
+                          (14, ".world", "unclosed block"),
+                          (15, ".cameras", "unclosed block")])
+        self.assertEqual(namespace.versioninfo.editorversion, "400")
+        self.assertEqual(namespace.world.skyname, "sky_day01_01")
+        self.assertFalse(hasattr(namespace.world, "lost"))
+        self.assertFalse(hasattr(namespace.world, "cameras"))
+
+    def test_recovery_resync(self):
+        text = "\n".join(["world", "{", '"id" "1"', "solid", "{", '"id" "2"', "}",
+                          "hidden", "{", "entity", "{", '"id" "3"', "}", "}",
+                          "entity", "{", '"id" "4"', "}",
+                          "cordons", "{", "cordon", "{", '"name" "a"', "}", "cordon", "{", '"name" "b"', "}", "}",
+                          "entity", "{", '"id" "5"', "{", "entity", "{", '"id" "6"', "}"])
+        diagnostics = list()
+        namespace = vmf_tool.parser.parse(text, diagnostics=diagnostics)
+        self.assertEqual([(d.line, d.scope, d.kind) for d in diagnostics],
+                         [(14, ".world", "unclosed block"),
+                          (32, ".entities[1]", "invalid block"),
+                          (33, ".entities[1]", "unclosed block")])
+        self.assertEqual(namespace.world.hidden.entity.id, "3")
+        self.assertEqual([e.id for e in namespace.entities], ["4", "5", "6"])
+        self.assertEqual([c.name for c in namespace.cordons.cordons], ["a", "b"])
+
+    def test_recover_vmf(self):
+        with open("tests/mapsrc/test2.vmf", "r") as source:
+            source_text = source.read()
+        corrupt_filename = "tests/mapsrc/test_corrupt_test2.vmf"
+        corruptions = {'"skyname" "sky_tf2_04"': '"skyname" "sky_tf2_04" "x"',
+                       '\t\t"id" "2"\n': '\t\t"id" "two"\n',
+                       "\nworld\n": '\n"world" "x"\n'}
+        expected = [[(".world", "malformed keyvalue"), (".world", "missing key")],
+                    [(".world.solids[0]", "invalid id")],
+                    [("", "invalid block"), ("", "missing block"), ("", "missing key"),
+                     ("", "missing key"), ("", "missing key")]]
+        for (old, new), kinds in zip(corruptions.items(), expected):
+            with open(corrupt_filename, "w") as corrupt:
+                corrupt.write(source_text.replace(old, new, 1))
+            try:
+                vmf = vmf_tool.Vmf(corrupt_filename, recover=True)
+            finally:
+                os.remove(corrupt_filename)
+            self.assertEqual([(d.scope, d.kind) for d in vmf.diagnostics], kinds)
+        self.assertEqual(vmf.skybox, None)
+        self.assertEqual(vmf.brushes, dict())
+
 
 class TestVmfMethods(unittest.TestCase):
 
@@ -19,8 +231,88 @@ class TestVmfMethods(unittest.TestCase):
             source_text = source.read()
         with open(save_filename, "r") as save:
             save_text = save.read()
+        save_mode = os.stat(save_filename).st_mode & 0o777
         os.remove(save_filename)
         self.assertEqual(source_text, save_text)
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(save_mode, 0o666 & ~umask)
+
+    def test_save_edited_block(self):
+        folder = os.path.dirname(self.source_filename)
+        filename = os.path.basename(self.source_filename)
+        edit_filename = os.path.join(folder, f"test_edit_{filename}")
+        shutil.copy(self.source_filename, edit_filename)
+        vmf = vmf_tool.Vmf(edit_filename)
+        vmf.raw_namespace.world.skyname = "sky_day01_01"
+        self.assertTrue(vmf.raw_namespace.world._dirty)
+        self.assertFalse(vmf.raw_namespace.versioninfo._dirty)
+        vmf.save_to_file()
+        self.assertFalse(vmf.raw_namespace.world._dirty)
+        with open(self.source_filename, "r") as source:
+            source_text = source.read()
+        with open(edit_filename, "r") as save:
+            save_text = save.read()
+        os.remove(edit_filename)
+        backup_filename = os.path.splitext(edit_filename)[0] + ".vmx"
+        with open(backup_filename, "r") as backup:
+            backup_text = backup.read()
+        os.remove(backup_filename)
+        self.assertEqual(source_text, backup_text)
+        self.assertEqual(source_text.replace('"sky_tf2_04"', '"sky_day01_01"'), save_text)
+
+    def test_save_plural_edits(self):
+        folder = os.path.dirname(self.source_filename)
+        filename = os.path.basename(self.source_filename)
+        edit_filename = os.path.join(folder, f"test_edit_{filename}")
+        shutil.copy(self.source_filename, edit_filename)
+        vmf = vmf_tool.Vmf(edit_filename)
+        solid_count = len(vmf.raw_namespace.world.solids)
+        del vmf.raw_namespace.world.solids[0]
+        vmf.raw_namespace.world.solids[0].sides.pop()
+        vmf.save_to_file()
+        saved_vmf = vmf_tool.Vmf(edit_filename)
+        os.remove(edit_filename)
+        os.remove(os.path.splitext(edit_filename)[0] + ".vmx")
+        self.assertEqual(len(saved_vmf.raw_namespace.world.solids), solid_count - 1)
+        self.assertEqual(len(saved_vmf.raw_namespace.world.solids[0].sides),
+                         len(vmf.raw_namespace.world.solids[0].sides))
+
+    def test_save_reordered_blocks(self):
+        folder = os.path.dirname(self.source_filename)
+        filename = os.path.basename(self.source_filename)
+        edit_filename = os.path.join(folder, f"test_edit_{filename}")
+        shutil.copy(self.source_filename, edit_filename)
+        vmf = vmf_tool.Vmf(edit_filename)
+        entities = vmf.raw_namespace.entities
+        entities[0], entities[1] = entities[1], entities[0]
+        self.assertFalse(vmf.can_splice())
+        vmf.save_to_file()
+        self.assertTrue(vmf.can_splice())  # the new order is now file order
+        saved_vmf = vmf_tool.Vmf(edit_filename)
+        os.remove(edit_filename)
+        os.remove(os.path.splitext(edit_filename)[0] + ".vmx")
+        self.assertEqual([e.id for e in saved_vmf.raw_namespace.entities], [e.id for e in entities])
+
+    def test_save_after_copy(self):
+        folder = os.path.dirname(self.source_filename)
+        filename = os.path.basename(self.source_filename)
+        edit_filename = os.path.join(folder, f"test_edit_{filename}")
+        shutil.copy(self.source_filename, edit_filename)
+        vmf = vmf_tool.Vmf(edit_filename)
+        solid = vmf.raw_namespace.world.solids[0]
+        duplicate = copy.copy(solid)  # shares sides with solid, which must stay their parent
+        duplicate.sides.pop()
+        self.assertTrue(duplicate._dirty)
+        self.assertFalse(vmf.raw_namespace.world._dirty)
+        self.assertEqual(len(duplicate.sides), len(solid.sides) - 1)
+        solid.sides[0].material = "EDITED/MAT"
+        self.assertTrue(vmf.raw_namespace.world._dirty)
+        vmf.save_to_file()
+        saved_vmf = vmf_tool.Vmf(edit_filename)
+        os.remove(edit_filename)
+        os.remove(os.path.splitext(edit_filename)[0] + ".vmx")
+        self.assertEqual(saved_vmf.raw_namespace.world.solids[0].sides[0].material, "EDITED/MAT")
 
     def tearDown(self):
         del self.source_filename
@@ -0,0 +1,30 @@
+"""Startup benchmark, run from the repo root with: python -m tests.bench_startup
+Each case runs in a fresh interpreter, as short-lived CLI hooks do"""
+import statistics
+import subprocess
+import sys
+import time
+
+
+cases = {
+    "python -c pass": "pass",
+    "import vmf_tool": "import vmf_tool",
+    "open and read one key": "\n".join([
+        "import vmf_tool",
+        "with open('tests/mapsrc/test.vmf') as vmf_file:",
+        "    vmf_tool.parser.parse(vmf_file).world.skyname"])}
+
+
+def time_case(code: str, runs: int = 20) -> float:
+    """median wall time (seconds) of running code in a new interpreter"""
+    times = list()
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    for name, code in cases.items():
+        print(f"{name:<24} {time_case(code) * 1000:7.2f} ms")
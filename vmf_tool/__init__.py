@@ -1,7 +1,25 @@
-"""A library for interpreting & editing .vmf files"""
+"""A library for interpreting & editing .vmf files
 
+Imports are kept light, so `import vmf_tool` stays fast:
+-- submodules are imported on first use (see __getattr__)
+-- typing is only imported under `if TYPE_CHECKING:`, annotations are never evaluated at runtime
+-- numpy is an optional dependency (pip install vmf_tool[numpy]), imported inside the functions which need it"""
 __all__ = ["brushes", "parser", "Vmf"]
 
-from . import brushes
-from . import parser
-from .vmf import Vmf
+submodules = ("brushes", "parser", "vector", "vmf")
+
+
+def __getattr__(name: str):
+    """submodules are imported on first use, keeping `import vmf_tool` fast"""
+    if name in submodules:
+        __import__(f"{__name__}.{name}")  # also sets the submodule as a global
+        return globals()[name]
+    elif name == "Vmf":
+        global Vmf
+        from .vmf import Vmf
+        return Vmf
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list:
+    return sorted({*globals(), *__all__, *submodules})
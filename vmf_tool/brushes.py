@@ -1,8 +1,12 @@
+import copy
 import re
 
 from . import vector
 
 
+POINT_BATCH_SIZE = 256  # points tested against every solid's bounding box at once, in points_in_solids
+
+
 def triangle_of(string):
     """"'(X Y Z) (X Y Z) (X Y Z)' --> (vec3(X, Y, Z), vec3(X, Y, Z), vec3(X, Y, Z))"""
     points = re.findall(r"(?<=\().+?(?=\))", string)
@@ -53,11 +57,47 @@ class Face:
         if hasattr(_namespace, "dispinfo"):
             self.displacement = Displacement(_namespace.dispinfo)
 
+        self.derived = None
+        # ^ FaceData, filled by derive_faces; recalculated when the plane or texture axes change
+
     def uv_at(self, position):
         u = self.uaxis.linear_pos(position)
         v = self.vaxis.linear_pos(position)
         return (u, v)
 
+    # derived data (requires numpy), use derive_faces to calculate for many faces at once
+    @property
+    def area(self):
+        return derive_faces([self])[0].area
+
+    @property
+    def centroid(self):
+        return derive_faces([self])[0].centroid
+
+    @property
+    def luxel_count(self):
+        """estimated lightmap size, in luxels"""
+        return derive_faces([self])[0].luxels
+
+    @property
+    def uv_bounds(self):
+        """(u_min, v_min), (u_max, v_max)"""
+        data = derive_faces([self])[0]
+        return data.uv_min, data.uv_max
+
+
+class FaceData:
+    """Values derived from a Face's polygon & texture axes, see derive_faces"""
+    __slots__ = ("area", "centroid", "key", "luxels", "uv_max", "uv_min")
+
+    def __init__(self, key, area, centroid, uv_min, uv_max, luxels):
+        self.key = key  # snapshot of the Face, if it changes this FaceData is stale
+        self.area = area
+        self.centroid = centroid
+        self.uv_min = uv_min
+        self.uv_max = uv_max
+        self.luxels = luxels
+
 
 class Displacement:
     def __init__(self, namespace):
@@ -90,9 +130,179 @@ class Displacement:
             # almost always 0-255 (256 has been observed in the wild)
             # almost always an integer (however floats have also been seen)
 
+        self.lod_cache = dict()
+        # ^ {power: (displacement_key(self), Displacement)}, filled by resampled & resample_displacements
+
     def change_power(self, new_power):
         """simplify / subdivide displacement further"""
-        raise NotImplementedError()
+        lod = self.resampled(new_power)
+        self.power = lod.power
+        self.normals, self.distances, self.alphas = lod.normals, lod.distances, lod.alphas
+        self.lod_cache = dict()
+
+    def resampled(self, new_power):
+        """returns a copy of this displacement at new_power (cached)"""
+        return resample_displacements([self], new_power)[0]
+
+
+def resample_displacements(displacements, new_power):
+    """returns each displacement resampled to new_power, reusing & filling each Displacement.lod_cache
+    subdivision interpolates offsets (normal * distance) & alphas bilinearly, simplification decimates
+    displacements of the same power are resampled together, as one stack of grids (requires numpy)"""
+    if new_power < 1:
+        raise RuntimeError(f"Invalid displacement power: {new_power}")
+    out, keys = list(), list()
+    by_power = dict()
+    # ^ {power: [index, index, ...]}
+    for i, displacement in enumerate(displacements):
+        key = displacement_key(displacement)
+        key_and_lod = displacement.lod_cache.get(new_power, None)
+        if key_and_lod is not None and key_and_lod[0] == key:
+            out.append(key_and_lod[1])
+        else:  # not cached, or the grids were edited since
+            out.append(None)
+            by_power.setdefault(displacement.power, []).append(i)
+        keys.append(key)
+    for power, indices in by_power.items():
+        if power == new_power:
+            lods = [same_power_copy(displacements[i]) for i in indices]
+        else:
+            lods = resample_grids([displacements[i] for i in indices], new_power)
+        for i, lod in zip(indices, lods):
+            lod.lod_cache = dict()
+            displacements[i].lod_cache[new_power] = (keys[i], lod)
+            out[i] = lod
+    return out
+
+
+def displacement_key(displacement):
+    """everything resample_displacements depends on: power & the normals, distances & alphas grids"""
+    return (displacement.power, *(axis for row in displacement.normals for normal in row for axis in normal),
+            *(d for row in displacement.distances for d in row), *(a for row in displacement.alphas for a in row))
+
+
+def same_power_copy(displacement):
+    """a copy of displacement which doesn't share it's grids"""
+    lod = copy.copy(displacement)
+    lod.normals = [[vector.vec3(*normal) for normal in row] for row in displacement.normals]
+    lod.distances = [tuple(row) for row in displacement.distances]
+    lod.alphas = [tuple(row) for row in displacement.alphas]
+    return lod
+
+
+def resample_grids(displacements, new_power):
+    """resamples a list of displacements which all share the same power"""
+    import numpy as np
+    old_size = 2 ** displacements[0].power + 1
+    new_size = 2 ** new_power + 1
+    normals = np.array([d.normals for d in displacements], dtype=float)  # (count, old_size, old_size, 3)
+    distances = np.array([d.distances for d in displacements], dtype=float)  # (count, old_size, old_size)
+    alphas = np.array([d.alphas for d in displacements], dtype=float)
+    if new_size < old_size:  # decimate; every new vertex is also an old vertex
+        step = (old_size - 1) // (new_size - 1)
+        normals = normals[:, ::step, ::step]
+        distances = distances[:, ::step, ::step]
+        alphas = alphas[:, ::step, ::step]
+    else:  # bilinear subdivision of offsets, then split back into normal & distance
+        normals = unit_vectors(normals)
+        offsets = bilinear(normals * distances[..., np.newaxis], new_size)
+        alphas = bilinear(alphas, new_size)
+        distances = np.linalg.norm(offsets, axis=-1)
+        normals = bilinear(normals, new_size)  # direction of vertices w/ no offset
+        nonzero = distances > 0
+        normals[nonzero] = offsets[nonzero] / distances[nonzero][:, np.newaxis]
+        normals = unit_vectors(normals)
+    lods = list()
+    for i, displacement in enumerate(displacements):
+        lod = copy.copy(displacement)
+        lod.power = new_power
+        lod.normals = [list(map(vector.vec3, row)) for row in normals[i].tolist()]
+        lod.distances = list(map(tuple, distances[i].tolist()))
+        lod.alphas = list(map(tuple, alphas[i].tolist()))
+        lods.append(lod)
+    return lods
+
+
+def unit_vectors(vectors):
+    """normalises an array of vectors (last axis), zero vectors are left as is"""
+    import numpy as np
+    lengths = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0)
+
+
+def bilinear(grids, size):
+    """bilinearly resamples a stack of square grids (axes 1 & 2) to size x size"""
+    import numpy as np
+    old_size = grids.shape[1]
+    t = np.linspace(0, old_size - 1, size)
+    index = np.minimum(t.astype(int), old_size - 2)
+    weight = (t - index).reshape((1, size) + (1,) * (grids.ndim - 2))
+    grids = grids[:, index] * (1 - weight) + grids[:, index + 1] * weight
+    weight = weight.reshape((1, 1, size) + (1,) * (grids.ndim - 3))
+    return grids[:, :, index] * (1 - weight) + grids[:, :, index + 1] * weight
+
+
+def face_key(face):
+    """everything derive_faces depends on: plane, polygon, texture axes & lightmap scale"""
+    normal, distance = face.plane
+    return (*normal, distance, *face.uaxis.vector, face.uaxis.offset, face.uaxis.scale,
+            *face.vaxis.vector, face.vaxis.offset, face.vaxis.scale, face.lightmap_scale,
+            len(face.polygon), *(axis for vertex in face.polygon for axis in vertex))
+
+
+def derive_faces(faces):
+    """returns a FaceData for each face, recalculating all stale faces together (requires numpy)
+    luxel counts follow vbsp: world-space texture axes / lightmap scale, snapped outwards, + 1 in each axis"""
+    import numpy as np
+    stale, keys = list(), list()
+    for face in faces:
+        key = face_key(face)
+        if face.derived is not None and face.derived.key == key:
+            continue
+        elif len(face.polygon) == 0:
+            face.derived = FaceData(key, 0.0, vector.vec3(), (0.0, 0.0), (0.0, 0.0), 0)
+        else:
+            stale.append(face)
+            keys.append(key)
+    if len(stale) > 0:
+        counts = np.array([len(f.polygon) for f in stale])
+        starts = np.cumsum(counts) - counts
+        vertices = np.array([v for f in stale for v in f.polygon], dtype=float)  # (vertex_count, 3)
+        vertex_face = np.repeat(np.arange(len(stale)), counts)
+        # triangle fans: (polygon[0], polygon[i], polygon[i + 1])
+        fan_counts = np.maximum(counts - 2, 0)
+        fan_face = np.repeat(np.arange(len(stale)), fan_counts)
+        fan_index = np.arange(fan_counts.sum()) - np.repeat(np.cumsum(fan_counts) - fan_counts, fan_counts) + 1
+        A = vertices[starts[fan_face]]
+        B = vertices[starts[fan_face] + fan_index]
+        C = vertices[starts[fan_face] + fan_index + 1]
+        triangle_areas = np.linalg.norm(np.cross(B - A, C - A), axis=1) / 2
+        areas = np.bincount(fan_face, triangle_areas, minlength=len(stale))
+        # area weighted centroid, vertex average for degenerate polygons
+        centroids = np.add.reduceat(vertices, starts) / counts[:, np.newaxis]
+        weighted = np.stack([np.bincount(fan_face, triangle_areas * (A + B + C)[:, i] / 3, minlength=len(stale))
+                             for i in range(3)], axis=1)
+        has_area = areas > 0
+        centroids[has_area] = weighted[has_area] / areas[has_area, np.newaxis]
+        # texture & lightmap projection
+        uv_min, uv_max, extents = list(), list(), list()
+        for axis in ("uaxis", "vaxis"):
+            vectors = np.array([getattr(f, axis).vector for f in stale])[vertex_face]
+            offsets = np.array([getattr(f, axis).offset for f in stale])[vertex_face]
+            scales = np.array([getattr(f, axis).scale for f in stale])[vertex_face]
+            lightmap_scales = np.array([f.lightmap_scale for f in stale])[vertex_face]
+            projected = np.einsum("ij,ij->i", vertices, vectors)
+            uv = (projected + offsets) / scales  # TextureVector.linear_pos
+            uv_min.append(np.minimum.reduceat(uv, starts))
+            uv_max.append(np.maximum.reduceat(uv, starts))
+            luxel = projected / lightmap_scales
+            extents.append(np.ceil(np.maximum.reduceat(luxel, starts)) - np.floor(np.minimum.reduceat(luxel, starts)) + 1)
+        luxels = (extents[0] * extents[1]).astype(int)
+        for i, face in enumerate(stale):
+            face.derived = FaceData(keys[i], float(areas[i]), vector.vec3(*centroids[i].tolist()),
+                                    (float(uv_min[0][i]), float(uv_min[1][i])),
+                                    (float(uv_max[0][i]), float(uv_max[1][i])), int(luxels[i]))
+    return [f.derived for f in faces]
 
 
 class Solid:
@@ -139,6 +349,16 @@ class Solid:
     def __repr__(self):
         return f"<Solid id={self.id}, {len(self.faces)} sides>"
 
+    @property
+    def area(self):
+        """total surface area (requires numpy)"""
+        return sum(d.area for d in derive_faces(self.faces))
+
+    @property
+    def luxel_count(self):
+        """estimated total lightmap size, in luxels (requires numpy)"""
+        return sum(d.luxels for d in derive_faces(self.faces))
+
     def translate(self, offset):
         """offset is a vector"""
         raise NotImplementedError()
@@ -167,3 +387,101 @@ def clip(poly, plane):
             split_verts["front"].append(cut_point)
             # ^ won't one of these points be added twice?
     return split_verts
+
+
+def points_in_solids(points, solids, epsilon=0.01):
+    """tests many points against many solids (requires numpy)
+    candidates are found by bounding box, POINT_BATCH_SIZE points at a time, then checked against each plane
+    returns (point_indices, solid_indices) numpy arrays, sorted by point; each pair is a point inside (or on) a solid"""
+    import numpy as np
+    points = np.array(points, dtype=float).reshape(-1, 3)
+    point_indices, solid_indices = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+    if len(solids) == 0:
+        return point_indices[0], solid_indices[0]
+    mins, maxs = map(np.array, zip(*map(bounds_of, solids)))
+    mins, maxs = mins - epsilon, maxs + epsilon
+    normals = np.array([f.plane[0] for s in solids for f in s.faces], dtype=float)  # (face_count, 3)
+    distances = np.array([f.plane[1] for s in solids for f in s.faces], dtype=float)
+    face_counts = np.array([len(s.faces) for s in solids])
+    first_faces = np.cumsum(face_counts) - face_counts
+    # ^ the faces of solids[i] are normals[first_faces[i]:first_faces[i] + face_counts[i]]
+    for start in range(0, len(points), POINT_BATCH_SIZE):
+        batch = points[start:start + POINT_BATCH_SIZE]
+        in_box = np.ones((len(batch), len(solids)), dtype=bool)
+        for axis in range(3):
+            in_box &= (mins[:, axis] <= batch[:, axis, None]) & (batch[:, axis, None] <= maxs[:, axis])
+        candidate_points, candidate_solids = in_box.nonzero()
+        if len(candidate_points) == 0:
+            continue
+        # every face of each candidate solid, paired with the candidate point
+        counts = face_counts[candidate_solids]  # never 0, a solid without faces has no box
+        first_pair_faces = np.cumsum(counts) - counts
+        faces = np.repeat(first_faces[candidate_solids] - first_pair_faces, counts) + np.arange(counts.sum())
+        pair_points = batch[np.repeat(candidate_points, counts)]
+        heights = np.einsum("ij,ij->i", pair_points, normals[faces]) - distances[faces]  # > 0 is outside that face
+        inside = np.maximum.reduceat(heights, first_pair_faces) <= epsilon
+        point_indices.append(candidate_points[inside] + start)
+        solid_indices.append(candidate_solids[inside])
+    return np.concatenate(point_indices), np.concatenate(solid_indices)
+
+
+def bounds_of(solid):
+    """returns the axis-aligned bounding box of solid -> (mins, maxs) (requires numpy)"""
+    import numpy as np
+    vertices = np.array([v for f in solid.faces for v in f.polygon], dtype=float).reshape(-1, 3)
+    if len(vertices) == 0:  # degenerate solid, an inside-out box never overlaps anything
+        return np.full(3, np.inf), np.full(3, -np.inf)
+    return vertices.min(axis=0), vertices.max(axis=0)
+
+
+def aabb_pairs(mins, maxs):
+    """broad-phase sweep & prune over bounding boxes (numpy arrays of shape (count, 3))
+    returns [(i, j), ...] for each pair of boxes which touch or overlap, with i < j"""
+    import numpy as np
+    order = np.argsort(mins[:, 0], kind="stable")
+    pairs = list()
+    active = np.empty(0, dtype=int)
+    # ^ boxes whose x range may still reach the next box
+    for i in order:
+        active = active[maxs[active, 0] >= mins[i, 0]]
+        hits = active[np.all((mins[active, 1:] <= maxs[i, 1:]) & (mins[i, 1:] <= maxs[active, 1:]), axis=1)]
+        pairs.extend((min(i, j), max(i, j)) for j in hits.tolist())
+        active = np.append(active, i)
+    return sorted(pairs)
+
+
+def separating_axes_of(solid):
+    """returns (vertices, face normals, edge directions) of solid as numpy arrays, for solids_overlap"""
+    import numpy as np
+    vertices = np.array([v for f in solid.faces for v in f.polygon], dtype=float).reshape(-1, 3)
+    vertices = np.unique(np.round(vertices, 2), axis=0)
+    normals = np.array([f.plane[0] for f in solid.faces], dtype=float)
+    edges = [np.empty((0, 3))]
+    for face in solid.faces:
+        if len(face.polygon) < 2:  # clipped away entirely, e.g. a redundant plane
+            continue
+        polygon = np.array(face.polygon, dtype=float)
+        edges.append(np.roll(polygon, -1, axis=0) - polygon)
+    edges = np.concatenate(edges)
+    lengths = np.linalg.norm(edges, axis=1, keepdims=True)
+    edges = edges[lengths[:, 0] > 0] / lengths[lengths[:, 0] > 0]
+    return vertices, normals, edges
+
+
+def solids_overlap(a, b, epsilon=0.01):
+    """separating axis test; True if solids a & b intersect by more than epsilon (touching is not overlap)
+    a & b are the outputs of separating_axes_of (requires numpy)"""
+    import numpy as np
+    vertices_a, normals_a, edges_a = a
+    vertices_b, normals_b, edges_b = b
+    if len(vertices_a) == 0 or len(vertices_b) == 0:  # degenerate solid
+        return False
+    crosses = np.cross(edges_a[:, np.newaxis], edges_b[np.newaxis]).reshape(-1, 3)
+    lengths = np.linalg.norm(crosses, axis=1, keepdims=True)
+    crosses = crosses[lengths[:, 0] > 1e-6] / lengths[lengths[:, 0] > 1e-6]
+    axes = np.concatenate([normals_a, normals_b, crosses])
+    projected_a = vertices_a @ axes.T  # (vertex_count, axis_count)
+    projected_b = vertices_b @ axes.T
+    separated = (projected_a.max(axis=0) <= projected_b.min(axis=0) + epsilon) | \
+                (projected_b.max(axis=0) <= projected_a.min(axis=0) + epsilon)
+    return not separated.any()
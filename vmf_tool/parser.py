@@ -1,12 +1,20 @@
 from __future__ import annotations
 
 import io
-import re
-from typing import Any, ItemsView, Iterable, List, Mapping, Union
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import mmap
+    from typing import Any, ItemsView, Iterable, List, Mapping, Tuple, Union
 
-def parse(string_or_file: Union[str, io.TextIOWrapper, io.StringIO]) -> Namespace:
-    """.vmf text -> Namespace"""
+
+def parse(string_or_file: Union[str, io.TextIOWrapper, io.StringIO], first_line: int = 0,
+          diagnostics: List[Diagnostic] = None) -> Namespace:
+    """.vmf text -> Namespace
+    first_line: line number of the text's first line, for text cut from a larger file
+    diagnostics: recovery mode; problems are appended to this list instead of raised
+    -- malformed lines are skipped, blocks which cannot be opened are skipped up to their closing brace
+    -- a top-level block name (e.g. world) inside another block closes all open blocks"""
     if not isinstance(string_or_file, (str, io.TextIOWrapper, io.StringIO)):
         raise RuntimeError(f"{string_or_file} is neither a string nor a file")
     if isinstance(string_or_file, str):  # make string file-like
@@ -17,47 +25,343 @@ def parse(string_or_file: Union[str, io.TextIOWrapper, io.StringIO]) -> Namespac
     namespace = Namespace()
     current_scope = Scope()
     previous_line = str()
-    for line_number, line in enumerate(file.readlines()):
+    skipped = list()  # recovery mode: names of the malformed block & its children while skipping them
+    for line_number, line in enumerate(file.readlines(), first_line):
         try:
-            new_namespace = Namespace(_line=line_number)
-            current_target = current_scope.get_from(namespace)
             line = line.strip()  # cleanup spacing
             if line == "" or line.startswith("//"):  # ignore blank / comments
                 continue
-            elif line == "{":  # START declaration
+            elif line in top_level_lines and diagnostics is not None and lost_closing_brace(
+                    line, skipped or current_scope.tiers):
+                # resync at the next top-level block
+                diagnostics.append(Diagnostic(line_number, current_scope, "unclosed block", line))
+                current_scope.tiers.clear()
+                skipped.clear()
+                previous_line = line
+                continue
+            elif len(skipped) > 0:  # resync at the end of the malformed block
+                if line == "{":
+                    skipped.append(previous_line)
+                elif line == "}":
+                    skipped.pop()
+                previous_line = line
+                continue
+            current_target = current_scope.get_from(namespace)
+            if line == "{":  # START declaration
+                tier_count = len(current_scope.tiers)
+                if diagnostics is not None and (previous_line in ("", "{", "}") or '" "' in previous_line):
+                    raise RuntimeError(f"{previous_line!r} is not a block name")
+                # NOTE: writing to __dict__ directly skips dirty-tracking, a fresh parse is clean
+                new_namespace = Namespace(_line=line_number)
+                new_namespace._parent = current_target
                 current_keys = current_target.__dict__.keys()
                 plural = pluralise(previous_line)
                 previous_line = previous_line.strip('"')
                 if previous_line in current_keys:  # NEW plural
-                    current_target[plural] = [current_target[previous_line]]  # create plural from old singular
+                    # create plural from old singular, w/ new_namespace as the second entry
+                    current_target.__dict__[plural] = Plural([current_target[previous_line], new_namespace], current_target)
                     current_target.__dict__.pop(previous_line)  # delete singular
-                    current_target[plural].append(new_namespace)  # second entry
                     current_scope.add(plural)
                     current_scope.add(1)  # point at new_namespace
                 elif plural in current_keys:  # APPEND plural
                     current_scope.add(plural)  # point at plural
-                    current_scope.get_from(namespace).append(new_namespace)
+                    list.append(current_scope.get_from(namespace), new_namespace)  # skips Plural's dirty-tracking
                     current_scope.add(len(current_scope.get_from(namespace)) - 1)  # current index in plural
                 else:  # NEW singular
                     current_scope.add(previous_line)
-                    current_scope.set_in(namespace, new_namespace)
+                    current_target.__dict__[previous_line] = new_namespace
             elif line == "}":  # END declaration
                 current_scope.retreat()
             elif '" "' in line:  # "KEY" "VALUE"
                 key, value = line.split('" "')
                 key = key.lstrip('"')
                 value = value.rstrip('"')
-                current_target[key] = value
+                current_target.__dict__[key] = value
             elif line.count(" ") == 1:  # KEY VALUE
                 key, value = line.split()
-                current_target[key] = value
+                current_target.__dict__[key] = value
             previous_line = line
         except Exception as exc:
-            print("error on line {0:04d}:\n{1}\n{2}".format(line_number, previous_line, line))
-            raise exc
+            if diagnostics is None:
+                print("error on line {0:04d}:\n{1}\n{2}".format(line_number, previous_line, line))
+                raise exc
+            if line == "{":
+                del current_scope.tiers[tier_count:]  # undo any half-opened block
+                diagnostics.append(Diagnostic(line_number, current_scope, "invalid block", f"{exc}"))
+                skipped.append(previous_line)
+            elif line == "}":
+                diagnostics.append(Diagnostic(line_number, current_scope, "unexpected closing brace", line))
+            else:
+                diagnostics.append(Diagnostic(line_number, current_scope, "malformed keyvalue", line))
+            previous_line = line
+    if diagnostics is not None and len(current_scope.tiers) > 0:
+        diagnostics.append(Diagnostic(line_number, current_scope, "unclosed block", "end of file"))
     return namespace
 
 
+top_level_blocks = ("versioninfo", "visgroups", "viewsettings", "world", "entity", "cameras", "cordon", "cordons")
+top_level_lines = frozenset((*top_level_blocks, *(f'"{name}"' for name in top_level_blocks)))
+# ^ cheap test before lost_closing_brace, which would otherwise run on every line
+nested_top_level_blocks = {"cordon": "cordons", "entity": "hidden"}
+# ^ {block name: the only block it may appear in, other than the top level}
+
+
+def lost_closing_brace(line: str, tiers: list) -> bool:
+    """recovery mode: is line a top-level block name found inside another block?
+    tiers: Scope.tiers, or the names of the blocks being skipped"""
+    name = line.strip('"')
+    if len(tiers) == 0 or name not in top_level_blocks:
+        return False
+    if isinstance(tiers[-1], int):  # inside a plural
+        parent = singularise(tiers[-2])
+    else:
+        parent = tiers[-1].strip('"')
+    return nested_top_level_blocks.get(name) != parent
+
+
+class Diagnostic:
+    """A problem found while parsing in recovery mode"""
+    __slots__ = ("line", "scope", "kind", "text")
+    line: int  # line number (from 0)
+    scope: str  # repr of the Scope the problem was found in, e.g. ".world.solids[3]"
+    kind: str  # parse: "invalid block", "unexpected closing brace", "malformed keyvalue" or "unclosed block"
+    # ^ Vmf: "missing block", "missing key", "invalid id" or "invalid solid"
+    text: str  # offending line / error message
+
+    def __init__(self, line: int, scope: Union[Scope, str], kind: str, text: str):
+        self.line = line
+        self.scope = scope if isinstance(scope, str) else repr(scope)
+        self.kind = kind
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"<Diagnostic line {self.line:04d} {self.scope or '(top level)'} {self.kind}: {self.text}>"
+
+
+def parse_parallel(filename: str, processes: int = None, chunk_size: int = 2 ** 22) -> Namespace:
+    """.vmf file -> Namespace, identical to parse(open(filename))
+    Blocks are cut from the file with a quick brace scan & parsed in a pool of processes.
+    The contents of any top-level block larger than chunk_size (usually world) are cut up too.
+    Falls back to parse if the file cannot be cut safely."""
+    import concurrent.futures
+    import locale
+    with open(filename, "rb") as vmf_file:
+        data = vmf_file.read()
+    plan = chunk_plan(data, chunk_size) if processes != 1 else None
+    if plan is None:
+        with open(filename, "r") as vmf_file:
+            return parse(vmf_file)
+    blocks, pieces = plan
+    # batch consecutive pieces into chunks of roughly chunk_size bytes
+    batches = [[]]
+    batch_size = 0
+    for first_line, start, end in pieces:
+        if batch_size >= chunk_size:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append((first_line, data[start:end]))
+        batch_size += end - start
+    del data
+    encoding = locale.getpreferredencoding(False)  # matches open(filename, "r")
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        parsed = list()
+        for batch in pool.map(parse_pieces, batches, [encoding] * len(batches)):
+            parsed.extend(batch)
+    # stitch the pieces back together, in file order
+    namespace = Namespace()
+    for block in blocks:
+        if isinstance(block, int):  # a whole top-level block
+            name, compact = parsed[block]
+            insert_block(namespace, name, namespace_from(compact))
+            continue
+        header, brace_line, contents = block  # a top-level block which was cut up
+        outer = Namespace(_line=brace_line)
+        for item in contents:
+            if isinstance(item, int):  # child block
+                name, compact = parsed[item]
+                insert_block(outer, name, namespace_from(compact))
+            else:  # keyvalues between child blocks
+                for key, value in parse(io.StringIO(item.decode(encoding), newline=None)).items():
+                    outer.__dict__[key] = value
+        insert_block(namespace, header, outer)
+    return namespace
+
+
+def chunk_plan(data: bytes, chunk_size: int) -> Tuple[list, List[Tuple[int, int, int]]]:
+    """plans how parse_parallel cuts up data -> (blocks, pieces) or None if data is unsafe to cut
+    pieces: [(first_line, start, end), ...] blocks for the pool to parse, in file order
+    blocks: [piece index or (header, brace line number, [piece index or keyvalue bytes, ...]), ...]"""
+    if len(data) <= chunk_size or data.count(b"\r") != data.count(b"\r\n"):
+        return None  # too small to be worth it / old mac line endings, which need readlines to count
+    top_level = block_bounds(data)
+    if top_level is None:
+        return None
+
+    def blank(start: int, end: int) -> bool:  # only whitespace & comments
+        return all(line.strip() == b"" or line.strip().startswith(b"//") for line in data[start:end].split(b"\n"))
+
+    def safe(header: bytes) -> bool:  # cannot be misread as a keyvalue, pluralises the same once stripped
+        return header != b"" and b" " not in header and b'"' not in header
+
+    line_number = [0, 0]  # position, line number
+
+    def line_of(position: int) -> int:  # positions must be requested in ascending order
+        line_number[1] += data.count(b"\n", line_number[0], position)
+        line_number[0] = position
+        return line_number[1]
+
+    blocks, pieces = list(), list()
+    previous_end = 0
+    for header, start, inner_start, inner_end, end in top_level:
+        if not safe(header) or not blank(previous_end, start):
+            return None  # top-level keyvalues are left to parse
+        previous_end = end
+        name = header.decode("utf-8", "replace")
+        children = block_bounds(data, inner_start, inner_end) if end - start > chunk_size else list()
+        if len(children) == 0:
+            blocks.append(len(pieces))
+            pieces.append((line_of(start), start, end))
+            continue
+        contents = list()
+        brace_line = line_of(inner_start) - 1
+        gap_start = inner_start
+        for child_header, child_start, i, j, child_end in children:
+            if not safe(child_header):
+                return None
+            if not blank(gap_start, child_start):
+                contents.append(data[gap_start:child_start])
+            contents.append(len(pieces))
+            pieces.append((line_of(child_start), child_start, child_end))
+            gap_start = child_end
+        if not blank(gap_start, inner_end):
+            contents.append(data[gap_start:inner_end])
+        blocks.append((name, brace_line, contents))
+    if not blank(previous_end, len(data)):
+        return None
+    return blocks, pieces
+
+
+def parse_pieces(pieces: List[Tuple[int, bytes]], encoding: str) -> List[Tuple[str, dict]]:
+    """parse_parallel worker; parses each piece (a single block) -> [(name, compact_of(block)), ...]"""
+    out = list()
+    for first_line, piece in pieces:
+        namespace = parse(io.StringIO(piece.decode(encoding), newline=None), first_line)
+        (name, block), = namespace.items()
+        out.append((name, compact_of(block)))
+    return out
+
+
+def compact_of(namespace: Namespace) -> dict:
+    """Namespace -> nested dicts & lists, which pickle & unpickle much faster than Namespaces"""
+    compact = dict()
+    for key, value in namespace.items():
+        if isinstance(value, Namespace):
+            value = compact_of(value)
+        elif isinstance(value, list):
+            value = [compact_of(v) if isinstance(v, Namespace) else v for v in value]
+        compact[key] = value
+    return compact
+
+
+def namespace_from(compact: dict, parent: Namespace = None) -> Namespace:
+    """compact_of(namespace) -> namespace, reusing compact's dicts; the result is clean"""
+    namespace = Namespace.__new__(Namespace)
+    object.__setattr__(namespace, "_dirty", False)
+    object.__setattr__(namespace, "_parent", parent)
+    for key, value in compact.items():
+        if type(value) is dict:
+            compact[key] = namespace_from(value, namespace)
+        elif type(value) is list:
+            compact[key] = Plural([namespace_from(v, namespace) if type(v) is dict else v for v in value], namespace)
+    object.__setattr__(namespace, "__dict__", compact)
+    return namespace
+
+
+def insert_block(target: Namespace, name: str, block: Namespace):
+    """adds a block to target, pluralising the same way parse does"""
+    keys = target.__dict__
+    plural = pluralise(name)
+    if name in keys:  # NEW plural
+        keys[plural] = Plural([keys[name], block], target)
+        keys.pop(name)
+    elif plural in keys:  # APPEND plural
+        list.append(keys[plural], block)  # skips Plural's dirty-tracking
+    else:  # NEW singular
+        keys[name] = block
+    block._parent = target
+
+
+def block_spans(data: Union[bytes, mmap.mmap]) -> List[Tuple[str, int, int]]:
+    """.vmf bytes -> [(name, start, end), ...] byte spans of each top-level block, in file order
+    start is the beginning of the block's name line, end is just after it's closing brace's line"""
+    bounds = block_bounds(data)
+    if bounds is None:  # unbalanced braces, spans would be misleading
+        return list()
+    return [(header.decode("utf-8", "replace").strip('"'), start, end) for header, start, i, j, end in bounds]
+
+
+def block_bounds(data: Union[bytes, mmap.mmap], start: int = 0, end: int = None) -> List[Tuple[bytes, int, int, int, int]]:
+    """finds each outermost block in data[start:end] (start & end must be at the start of a line)
+    -> [(header, start, inner_start, inner_end, end), ...] or None if braces are unbalanced
+    header is the block's name line, start -> end spans the whole block,
+    inner_start -> inner_end spans the lines between the block's braces"""
+    import re  # only paid for by callers who need spans
+    brace_line = re.compile(rb"^[ \t]*([{}])[ \t]*\r?$", re.MULTILINE)
+    end = len(data) if end is None else end
+    bounds = list()
+    depth = 0
+    for match in brace_line.finditer(data, start, end):
+        if match.group(1) == b"{":
+            if depth == 0:
+                block_start, header = header_of(data, match.start(), start)
+                inner_start = line_end(data, match.end())
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+            if depth == 0:
+                bounds.append((header, block_start, inner_start, match.start(), line_end(data, match.end())))
+        else:  # unbalanced closing brace
+            return None
+    return bounds if depth == 0 else None
+
+
+def header_of(data: Union[bytes, mmap.mmap], brace_start: int, floor: int = 0) -> Tuple[int, bytes]:
+    """finds the name line of the block opened at 'brace_start' -> (line start, stripped line)
+    mirrors parse; blank lines & comments between the name & it's brace are skipped"""
+    end = brace_start
+    while end > floor:
+        start = max(data.rfind(b"\n", floor, end - 1) + 1, floor)
+        line = data[start:end].strip()
+        if line != b"" and not line.startswith(b"//"):
+            return start, line
+        end = start
+    return floor, b""
+
+
+def line_end(data: Union[bytes, mmap.mmap], position: int) -> int:
+    """index of the start of the line after 'position'"""
+    newline = data.find(b"\n", position)
+    return len(data) if newline == -1 else newline + 1
+
+
+def scope_of(namespace: Namespace) -> Scope:
+    """finds where namespace is, by following it's parents up to the root Namespace"""
+    tiers = list()
+    child = namespace
+    while child._parent is not None:
+        for key, value in child._parent.items():
+            if value is child:
+                tiers[:0] = [key]
+                break
+            elif isinstance(value, list) and any(v is child for v in value):
+                tiers[:0] = [key, next(i for i, v in enumerate(value) if v is child)]
+                break
+        else:  # child has been removed from it's parent
+            break
+        child = child._parent
+    return Scope(tiers)
+
+
 def text_from(_dict: Union[dict, Namespace], tab_depth: int = 0) -> str:
     """Namespace / dictionary --> text resembling a .vmf"""
     out = list()
@@ -84,18 +388,18 @@ def text_from(_dict: Union[dict, Namespace], tab_depth: int = 0) -> str:
 
 class Scope:
     """Array of indices into a nested array"""
-    def __init__(self, tiers: list = []):
-        self.tiers = tiers
+    def __init__(self, tiers: list = None):
+        self.tiers = list() if tiers is None else tiers
 
     def __repr__(self) -> str:
         """returns a string which points to an attribute in a Namespace"""
         repr_strings = []
         for tier in self.tiers:
             if isinstance(tier, str):
-                if re.match("^[A-Za-z_][A-Za-z_0-9]*$", tier):
-                    repr_strings.append(".{tier}")
+                if tier.isidentifier():
+                    repr_strings.append(f".{tier}")
                 else:  # tier is not a valid attribute
-                    repr_strings.append("['{tier}']")
+                    repr_strings.append(f"['{tier}']")
             else:
                 repr_strings.append(f"[{tier}]")
         return "".join(repr_strings)
@@ -152,16 +456,34 @@ class Scope:
 class Namespace:
     """Maps objects like a dictionary, all keys are strings.
     Values can be accessed as class attributes.
-    If a key is not a valid attribute name, if can be used like a dictionary key."""
+    If a key is not a valid attribute name, if can be used like a dictionary key.
+    Setting or deleting a key flags this Namespace & all it's parents as dirty."""
+    __slots__ = ("__dict__", "_dirty", "_parent")
+    # ^ slots are kept out of __dict__, so they are never treated as keys
+    _dirty: bool  # edited since the last load / save
+    _parent: Namespace  # the Namespace this Namespace was set in
+
     def __init__(self, **presets: Mapping[str, Any]):
+        object.__setattr__(self, "_dirty", False)
+        object.__setattr__(self, "_parent", None)
         # absorb presets
         for key, value in presets.items():
             if isinstance(value, dict):
-                self[key] = Namespace(value)
+                value = Namespace(value)
             elif isinstance(value, list):
-                self[key] = [Namespace(i) for i in value]
-            else:
-                self[key] = value
+                value = [Namespace(i) for i in value]
+            self.__dict__[key] = self.adopt(value)
+
+    def __delattr__(self, key: str):
+        object.__delattr__(self, key)
+        self.mark_dirty()
+
+    def __setattr__(self, key: str, value: Any):
+        if key in Namespace.__slots__:
+            object.__setattr__(self, key, value)
+        else:
+            self.__dict__[key] = self.adopt(value)
+            self.mark_dirty()
 
     def __setitem__(self, index: Any, value: Any):
         setattr(self, str(index), value)
@@ -179,17 +501,143 @@ class Namespace:
         """based on collections.namedtuple's repr method"""
         attributes: List[str] = list()
         for attribute_name, attr in self.items():
-            if not re.match("^[A-Za-z_][A-Za-z_0-9]*$", attribute_name):
+            if not attribute_name.isidentifier():
                 # invalid attribute names are placed in quotes
                 attribute_name = f'"{attribute_name}"'
             attribute_string = f"{attribute_name}: {attr.__class__.__name__}"
             attributes.append(attribute_string)
         return f"<Namespace({', '.join(attributes)})>"
 
+    def __copy__(self) -> Namespace:
+        """shared children keep self as their parent; Plurals are copied, so in-place edits stay separate"""
+        copy = Namespace()
+        for key, value in self.__dict__.items():
+            copy.__dict__[key] = Plural(value, copy) if isinstance(value, list) else value
+        return copy
+
+    def __getstate__(self) -> dict:
+        """_parent & _dirty are left out, so deep copying / pickling a Namespace never copies it's parents"""
+        return self.__dict__
+
+    def __setstate__(self, state: dict):
+        """only used for fresh children (deepcopy / unpickle), which are adopted"""
+        object.__setattr__(self, "_dirty", False)
+        object.__setattr__(self, "_parent", None)
+        for key, value in state.items():
+            self.__dict__[key] = self.adopt(value)
+
+    def adopt(self, value: Any) -> Any:
+        """make self the parent of value (and of each Namespace in value, if value is a list)
+        lists are converted to Plurals, so in-place edits are tracked"""
+        if isinstance(value, list):
+            if not isinstance(value, Plural):
+                value = Plural(value)
+            value._owner = self
+        for child in (value if isinstance(value, list) else (value,)):
+            if isinstance(child, Namespace):
+                object.__setattr__(child, "_parent", self)
+        return value
+
     def items(self) -> ItemsView:
         """exposes self.__dict__"""
         return self.__dict__.items()
 
+    def mark_clean(self):
+        """Clear the dirty flag of self & all dirty children"""
+        # a clean Namespace never has dirty children, so clean branches are skipped
+        if not self._dirty:
+            return
+        object.__setattr__(self, "_dirty", False)
+        for value in self.__dict__.values():
+            for child in (value if isinstance(value, list) else (value,)):
+                if isinstance(child, Namespace):
+                    child.mark_clean()
+
+    def mark_dirty(self):
+        """Flag self & all parents as edited"""
+        namespace = self
+        while namespace is not None and not namespace._dirty:
+            object.__setattr__(namespace, "_dirty", True)
+            namespace = namespace._parent
+
+
+class Plural(list):
+    """The list of Namespaces under a plural key (e.g. world.solids)
+    In-place edits flag the owning Namespace as dirty & make it the parent of any new Namespaces."""
+    __slots__ = ("_owner",)
+    _owner: Namespace
+
+    def __init__(self, items: Iterable = (), owner: Namespace = None):
+        super().__init__(items)
+        self._owner = owner
+
+    def __delitem__(self, index: Union[int, slice]):
+        super().__delitem__(index)
+        self.edited()
+
+    def __iadd__(self, items: Iterable) -> Plural:
+        items = list(items)
+        super().__iadd__(items)
+        self.edited(items)
+        return self
+
+    def __imul__(self, count: int) -> Plural:
+        super().__imul__(count)
+        self.edited()
+        return self
+
+    def __reduce_ex__(self, protocol: int) -> tuple:
+        """the owner is left out of copies / pickles, it's re-adopted by Namespace.__setstate__"""
+        return (Plural, (list(self),))
+
+    def __setitem__(self, index: Union[int, slice], value: Any):
+        if isinstance(index, slice):
+            value = list(value)
+        super().__setitem__(index, value)
+        self.edited(value if isinstance(index, slice) else (value,))
+
+    def append(self, item: Any):
+        super().append(item)
+        self.edited((item,))
+
+    def clear(self):
+        super().clear()
+        self.edited()
+
+    def edited(self, new_items: Iterable = ()):
+        """adopt new_items & flag the owner as dirty"""
+        if self._owner is not None:
+            for item in new_items:
+                if isinstance(item, Namespace):
+                    object.__setattr__(item, "_parent", self._owner)
+            self._owner.mark_dirty()
+
+    def extend(self, items: Iterable):
+        items = list(items)
+        super().extend(items)
+        self.edited(items)
+
+    def insert(self, index: int, item: Any):
+        super().insert(index, item)
+        self.edited((item,))
+
+    def pop(self, index: int = -1) -> Any:
+        item = super().pop(index)
+        self.edited()
+        return item
+
+    def remove(self, item: Any):
+        super().remove(item)
+        self.edited()
+
+    def reverse(self):
+        super().reverse()
+        self.edited()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.edited()
+
 
 def pluralise(word: str) -> str:
     if word.endswith("f"):  # self -> selves
@@ -3,7 +3,11 @@ from __future__ import annotations
 
 import itertools
 import math
-from typing import Iterable, Union
+from collections.abc import Iterable
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Union
 
 
 class vec2:
@@ -1,53 +1,107 @@
+from __future__ import annotations
+
+import mmap
 import os
-import shutil
-from typing import Dict, List, Set
 
 from . import brushes
 from . import parser
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Dict, List, Set, Tuple
+
+
+COPY_CHUNK_SIZE = 2 ** 20  # bytes copied per read when splicing unedited blocks
+
 
 class Vmf:
+    blocks: List[Tuple[parser.Namespace, str, int, int]]
     brush_entities: Dict[int, Set[int]]
     brushes: Dict[int, brushes.Solid]
     detail_material: str
     detail_vbsp: str
+    diagnostics: List[parser.Diagnostic]
     entitites: Dict[int, parser.Namespace]
     import_errors: List[str]
     raw_brushes: Dict[int, parser.Namespace]
     raw_namespace: parser.Namespace
     skybox: str
     filename: str
+    source_stat: Tuple[int, int]
 
-    def __init__(self, filename: str) -> parser.Namespace:
+    def __init__(self, filename: str, processes: int = 1, recover: bool = False) -> parser.Namespace:
+        """processes: size of the process pool used by parser.parse_parallel (None for all cores)
+        recover: parse in recovery mode, collecting problems in self.diagnostics (always parses on 1 core)"""
         # how could a loading bar measure progress?
         self.filename = filename
-        with open(self.filename, "r") as vmf_file:
-            self.raw_namespace = parser.parse(vmf_file)
+        self.diagnostics = list()
+        if processes == 1 or recover:
+            with open(self.filename, "r") as vmf_file:
+                self.raw_namespace = parser.parse(vmf_file, diagnostics=self.diagnostics if recover else None)
+        else:
+            self.raw_namespace = parser.parse_parallel(self.filename, processes)
+        self.blocks = self.map_blocks()
         # map the raw Namespace with parser.scope
         # use Vmf @property to mutate the namespace directly
         # allowing for a remapped .vmf with edit history (CRDT support)
 
+        def id_of(namespace: parser.Namespace) -> int:
+            """int(namespace.id), or None & a Diagnostic in recovery mode"""
+            if not recover:
+                return int(namespace.id)
+            try:
+                return int(namespace.id)
+            except (AttributeError, TypeError, ValueError) as exc:
+                if isinstance(namespace, parser.Namespace):
+                    line, scope = getattr(namespace, "_line", -1), parser.scope_of(namespace)
+                else:  # a keyvalue mixed into a plural
+                    line, scope = -1, ""
+                self.diagnostics.append(parser.Diagnostic(line, scope, "invalid id", f"{exc.__class__.__name__}: {exc}"))
+                return None
+
         # Worldspawn:
-        self.skybox = self.raw_namespace.world.skyname
-        self.detail_material = self.raw_namespace.world.detailmaterial
-        self.detail_vbsp = self.raw_namespace.world.detailvbsp
+        world = getattr(self.raw_namespace, "world", None) if recover else self.raw_namespace.world
+        if not isinstance(world, parser.Namespace):  # recovery mode only
+            self.diagnostics.append(parser.Diagnostic(-1, "", "missing block", "world"))
+            world = parser.Namespace()  # placeholder, not added to self.raw_namespace
+
+        def world_value(key: str) -> str:
+            """world.key, or None & a Diagnostic in recovery mode"""
+            if not recover:
+                return getattr(world, key)
+            value = getattr(world, key, None)
+            if not isinstance(value, str):
+                self.diagnostics.append(parser.Diagnostic(
+                    getattr(world, "_line", -1), parser.scope_of(world), "missing key", key))
+                return None
+            return value
+
+        self.skybox = world_value("skyname")
+        self.detail_material = world_value("detailmaterial")
+        self.detail_vbsp = world_value("detailvbsp")
 
         self.raw_brushes = dict()
         # ^ {id: brush}
-        if hasattr(self.raw_namespace.world, "solid"):
-            self.raw_namespace.world.solids = [self.raw_namespace.world.solid]
-        if hasattr(self.raw_namespace.world, "solids"):
-            for brush in self.raw_namespace.world.solids:
-                self.raw_brushes[int(brush.id)] = brush
+        if hasattr(world, "solid"):
+            world.solids = [world.solid]
+        if hasattr(world, "solids"):
+            for brush in world.solids:
+                brush_id = id_of(brush)
+                if brush_id is not None:
+                    self.raw_brushes[brush_id] = brush
 
         self.entities = dict()
         # ^ {id: entity}
-        if hasattr(self.raw_namespace.world, "entity"):
-            entity = self.raw_namespace.world.entity
-            self.entities[int(entity.id)] = entity
-        elif hasattr(self.raw_namespace.world, "entities"):
-            for entity in self.raw_namespace.world.entities:
-                self.entities[int(entity.id)] = entity
+        if hasattr(world, "entity"):
+            entities = [world.entity]
+        elif hasattr(world, "entities"):
+            entities = world.entities
+        else:
+            entities = list()
+        for entity in entities:
+            entity_id = id_of(entity)
+            if entity_id is not None:
+                self.entities[entity_id] = entity
 
         self.brush_entities = dict()
         # ^ {entity.id: {brush.id, brush.id, ...}}
@@ -59,7 +113,9 @@ class Vmf:
                 self.brush_entities[entity.id] = set()
                 for brush in entity.solids:
                     if not isinstance(entity, str):
-                        brush_id = int(entity.solid.id)
+                        brush_id = id_of(entity.solid)
+                        if brush_id is None:
+                            continue
                         self.raw_brushes[brush_id] = entity.solid
                         self.brush_entities[entity_id].add(brush_id)
 
@@ -73,20 +129,212 @@ class Vmf:
                 self.import_errors.append("\n".join(
                     [f"Solid #{i} id: {brush_id} is invalid.",
                      f"{exc.__class__.__name__}: {exc}"]))
+                raw_brush = self.raw_brushes[brush_id]
+                self.diagnostics.append(parser.Diagnostic(
+                    getattr(raw_brush, "_line", -1), parser.scope_of(raw_brush),
+                    "invalid solid", f"{exc.__class__.__name__}: {exc}"))
             else:
                 self.brushes[brush_id] = brush
 
+        # the tidying above isn't a user edit, only edits from here on need saving
+        self.raw_namespace.mark_clean()
+
         # groups
         # user visgroups
         # worldspawn data
 
+    def brushes_containing(self, points, brush_ids: List[int] = None, epsilon: float = 0.01) -> Dict[int, List[int]]:
+        """tests many points against many brushes at once (requires numpy)
+        -> {point index: [id of each brush containing that point, ...]} for every point inside a brush"""
+        if brush_ids is None:
+            brush_ids = list(self.brushes)
+        inside = brushes.points_in_solids(points, [self.brushes[i] for i in brush_ids], epsilon)
+        out = dict()
+        for point_index, brush_index in zip(*inside):
+            out.setdefault(int(point_index), []).append(brush_ids[brush_index])
+        return out
+
+    def displacement_lods(self, power: int) -> Dict[Tuple[int, int], brushes.Displacement]:
+        """every displacement in self.brushes resampled to power -> {(brush.id, face.id): Displacement}
+        resampled in one batch, results are cached per displacement & power (requires numpy)"""
+        faces = [(brush.id, face) for brush in self.brushes.values() if brush.is_displacement
+                 for face in brush.faces if hasattr(face, "displacement")]
+        lods = brushes.resample_displacements([face.displacement for brush_id, face in faces], power)
+        return {(brush_id, face.id): lod for (brush_id, face), lod in zip(faces, lods)}
+
+    def overlapping_brushes(self, brush_ids: List[int] = None, epsilon: float = 0.01) -> List[Tuple[int, int]]:
+        """finds all pairs of brushes which intersect by more than epsilon (requires numpy)
+        candidates are found with an AABB sweep, then checked with the separating axis test"""
+        import numpy as np
+        if brush_ids is None:
+            brush_ids = list(self.brushes)
+        solids = [self.brushes[i] for i in brush_ids]
+        if len(solids) < 2:
+            return list()
+        mins, maxs = map(np.array, zip(*map(brushes.bounds_of, solids)))
+        axes = dict()
+        # ^ {index: brushes.separating_axes_of(solids[index])}, only for candidates
+        overlaps = list()
+        for i, j in brushes.aabb_pairs(mins - epsilon, maxs + epsilon):
+            for k in (i, j):
+                if k not in axes:
+                    axes[k] = brushes.separating_axes_of(solids[k])
+            if brushes.solids_overlap(axes[i], axes[j], epsilon):
+                overlaps.append((brush_ids[i], brush_ids[j]))
+        return overlaps
+
+    def lightmap_report(self) -> Dict[str, object]:
+        """estimates lightmap cost across every brush face in one pass (requires numpy)
+        tools/ materials are skipped, as they aren't lightmapped
+        -> {"faces": int, "area": float, "luxels": int,
+            "by_lightmap_scale": {scale: luxels}, "by_material": {material: luxels}}"""
+        import numpy as np
+        faces = [f for brush in self.brushes.values() for f in brush.faces
+                 if not f.material.upper().startswith("TOOLS/")]
+        derived = brushes.derive_faces(faces)
+        areas = np.array([d.area for d in derived], dtype=float)
+        luxels = np.array([d.luxels for d in derived], dtype=int)
+        report = {"faces": len(faces), "area": float(areas.sum()), "luxels": int(luxels.sum())}
+        for name, groups in (("by_lightmap_scale", [f.lightmap_scale for f in faces]),
+                             ("by_material", [f.material for f in faces])):
+            if len(faces) == 0:
+                report[name] = dict()
+                continue
+            group_names, group_index = np.unique(groups, return_inverse=True)
+            totals = np.bincount(group_index, luxels, minlength=len(group_names))
+            report[name] = {g.item(): int(t) for g, t in zip(group_names, totals)}
+        return report
+
+    def map_blocks(self, parsed: bool = True) -> List[Tuple[parser.Namespace, str, int, int]]:
+        """pairs each top-level block of self.raw_namespace with it's byte span in self.filename
+        -> [(namespace, name, start, end), ...] in file order; empty if the spans are unreliable
+        parsed: self.filename was parsed (ordered by _line) rather than written by parser.text_from"""
+        stat = os.stat(self.filename)
+        self.source_stat = (stat.st_size, stat.st_mtime_ns)
+        if stat.st_size == 0:
+            return list()
+        with open(self.filename, "rb") as vmf_file:
+            with mmap.mmap(vmf_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                spans = parser.block_spans(data)
+        namespaces = list()
+        for key, value in self.raw_namespace.items():
+            if isinstance(value, parser.Namespace):
+                namespaces.append((key, value))
+            elif isinstance(value, list):
+                namespaces.extend([(key, v) for v in value if isinstance(v, parser.Namespace)])
+        if parsed:
+            namespaces.sort(key=lambda kv: kv[1]._line)
+        if len(namespaces) != len(spans):
+            return list()
+        blocks = list()
+        for (key, namespace), (name, start, end) in zip(namespaces, spans):
+            if key not in (name, parser.pluralise(name)):
+                return list()
+            blocks.append((namespace, name, start, end))
+        return blocks
+
     def save_to_file(self, filename: str = ""):
+        """Unedited top-level blocks are copied byte-for-byte from self.filename, edited blocks are re-written.
+        Writes to a temporary file first, which then replaces filename; the old file is kept as .vmx"""
         # first, ensure all user edits will be represented in the saved file!
         # -- copying changes made to self.brushes to self.raw_namespace etc.
+        import shutil  # save-only imports are deferred to keep `import vmf_tool` fast
+        import tempfile
         if filename == "":
             filename = self.filename
-        if os.path.exists(filename):
-            old_filename, ext = os.path.splitext(filename)
-            shutil.copy(filename, f"{old_filename}.vmx")
-        with open(filename, "w") as file:
-            file.write(parser.text_from(self.raw_namespace))
+        folder = os.path.dirname(os.path.abspath(filename))
+        temp_descriptor, temp_filename = tempfile.mkstemp(suffix=".tmp", dir=folder)
+        try:
+            if self.can_splice():
+                with open(temp_descriptor, "wb") as file:
+                    new_blocks = self.splice_to(file)
+            else:  # full re-write
+                with open(temp_descriptor, "w") as file:
+                    file.write(parser.text_from(self.raw_namespace))
+                new_blocks = None
+            if os.path.exists(filename):
+                shutil.copymode(filename, temp_filename)
+                old_filename, ext = os.path.splitext(filename)
+                backup(filename, f"{old_filename}.vmx")
+            else:  # mkstemp makes owner-only files, match open(filename, "w") instead
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp_filename, 0o666 & ~umask)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        if os.path.abspath(filename) == os.path.abspath(self.filename):
+            # the saved file is our new source
+            self.raw_namespace.mark_clean()
+            self.blocks = new_blocks if new_blocks is not None else self.map_blocks(parsed=False)
+            stat = os.stat(self.filename)
+            self.source_stat = (stat.st_size, stat.st_mtime_ns)
+
+    def can_splice(self) -> bool:
+        """are self.blocks still valid spans into an unchanged self.filename?"""
+        if len(self.blocks) == 0 or not os.path.exists(self.filename):
+            return False
+        stat = os.stat(self.filename)
+        if (stat.st_size, stat.st_mtime_ns) != self.source_stat:
+            return False  # source was changed by someone else
+        # new, removed & re-ordered top-level blocks can only be placed with a full re-write
+        block_order = {id(namespace): i for i, (namespace, name, start, end) in enumerate(self.blocks)}
+        block_count = 0
+        for value in self.raw_namespace.__dict__.values():
+            if isinstance(value, parser.Namespace):
+                value = [value]
+            elif not isinstance(value, list):
+                return False  # top-level keyvalues aren't tracked
+            order = [block_order.get(id(namespace), -1) for namespace in value]
+            if -1 in order or order != sorted(order):
+                return False  # e.g. raw_namespace.entities.sort()
+            block_count += len(order)
+        return block_count == len(block_order)
+
+    def splice_to(self, file) -> List[Tuple[parser.Namespace, str, int, int]]:
+        """writes self.filename to file, re-writing only dirty blocks -> spans of blocks in file"""
+        import locale
+        import shutil
+        encoding = locale.getpreferredencoding(False)
+        new_blocks = list()
+        with open(self.filename, "rb") as source:
+            newline = b"\r\n" if source.readline().endswith(b"\r\n") else b"\n"
+            position = 0  # in source
+            for namespace, name, start, end in self.blocks:
+                copy_range(source, file, position, start)  # whitespace & comments between blocks
+                new_start = file.tell()
+                if namespace._dirty:
+                    text = parser.text_from({name: namespace})
+                    file.write(text.encode(encoding).replace(b"\n", newline))
+                else:
+                    copy_range(source, file, start, end)
+                new_blocks.append((namespace, name, new_start, file.tell()))
+                position = end
+            source.seek(position)
+            shutil.copyfileobj(source, file, COPY_CHUNK_SIZE)
+        return new_blocks
+
+
+def backup(filename: str, backup_filename: str):
+    """keeps the current contents of filename at backup_filename, even after filename is replaced"""
+    import shutil
+    if os.path.exists(backup_filename):
+        os.remove(backup_filename)
+    try:  # a hard link is instant, os.replace will give filename a new inode
+        os.link(filename, backup_filename)
+    except OSError:  # filesystem doesn't support hard links
+        shutil.copy(filename, backup_filename)
+
+
+def copy_range(source, destination, start: int, end: int):
+    """copies bytes start -> end from source to destination in buffered chunks"""
+    source.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = source.read(min(remaining, COPY_CHUNK_SIZE))
+        if chunk == b"":
+            break
+        destination.write(chunk)
+        remaining -= len(chunk)